@@ -1,12 +1,21 @@
 from fastapi import FastAPI, File, UploadFile, Query, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import io
+import os
 import csv
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
 import fitz  # PyMuPDF
-from datetime import datetime
-import re
-from collections import defaultdict
+import orjson
+from sys import intern
+from itertools import repeat
+from parser_core import BANK_LAYOUTS, extract_lines_by_y, split_blocks, block_date, classify_block, format_cents
 
 app = FastAPI()
 
@@ -18,157 +27,207 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def extract_lines_by_y(page):
-    words = page.get_text("words")
-    if not words:
-        return []
-
-    lines = defaultdict(list)
-    for w in words:
-        x0, y0, x1, y1, word, *_ = w
-        y_key = round(y0, 1)
-        lines[y_key].append((x0, word))
-
-    ordered_lines = []
-    for y in sorted(lines.keys()):
-        line_words = sorted(lines[y], key=lambda x: x[0])
-        line = {
-            "y": y,
-            "line": " ".join(word for _, word in line_words),
-            "positions": [x for x, _ in line_words],
-            "xmap": [(x, word) for x, word in line_words]
-        }
-        ordered_lines.append(line)
-
-    return ordered_lines
-
-def is_date(text):
-    return re.match(r"^\d{1,2}[\/\-\s]\d{1,2}[\/\-\s]\d{2,4}$", text)
-
-def is_amount(text):
-    return re.match(r"^[\d\s]+\.\d{2}$", text)
-
-# Define column zones per bank
-COLUMN_ZONES = {
-    "absa": {
-        "description": (95, 305),
-        "debit": (310, 390),
-        "credit": (395, 470),
-        "balance": (475, 999)
-    },
-    # Future banks can be added here
-}
-
-@app.post("/parse")
-async def parse_pdf(file: UploadFile = File(...), bank: str = Query("absa"), debug: bool = Query(False), preview: bool = Query(False)):
-    content = await file.read()
+class OrjsonResponse(JSONResponse):
+    # orjson rendering without FastAPI's ORJSONResponse, which is deprecated.
+    # The endpoint returns these directly so FastAPI doesn't first run the
+    # transaction list through jsonable_encoder
+    def render(self, content):
+        return orjson.dumps(content)
+
+CSV_FIELDS = ("date", "description", "amount", "balance", "calculated_balance", "type", "balance_diff_error")
+
+# Documents with at least this many pages are read in worker processes.
+# In-process reading costs about 1.8 ms a page (22 ms for a 12-page
+# statement), while a round trip through the pool adds about 18 ms for the
+# document reopen and result pickling (40 ms for the same statement on one
+# worker). With four workers the split only pays off from about 14 pages
+PARALLEL_PAGE_THRESHOLD = 16
+# The pool is shared by all requests, so it is capped rather than given a
+# process per core; on one CPU there is no pool at all
+PAGE_WORKERS = min(os.cpu_count() or 1, 4)
+
+def read_page_lines(page):
+    return extract_lines_by_y(page.get_text("words"))
+
+def read_page_range(path, start, stop):
+    # Runs in a worker process, which opens its own copy of the document
+    # once for its whole slice of pages
+    with fitz.open(path, filetype="pdf") as doc:
+        return [read_page_lines(doc[i]) for i in range(start, stop)]
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def page_pool():
+    # PyMuPDF objects are not thread-safe, so pages are spread over processes;
+    # spawn avoids forking the server's threads into the workers. The lock
+    # keeps concurrent first requests from each starting a pool
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            _page_pool = ProcessPoolExecutor(max_workers=PAGE_WORKERS, mp_context=get_context("spawn"))
+        return _page_pool
+
+def discard_page_pool(pool):
+    # A worker that died (MuPDF crash, OOM kill) leaves the executor broken
+    # for good; drop it so the next caller starts a fresh one. Only the pool
+    # that failed is dropped, in case another request already replaced it
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is pool:
+            _page_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def read_page_ranges(path, starts, stops):
+    pool = page_pool()
+    try:
+        return list(pool.map(read_page_range, repeat(path), starts, stops))
+    except BrokenProcessPool:
+        discard_page_pool(pool)
+        raise
+
+def read_document_lines(path):
+    with fitz.open(path, filetype="pdf") as doc:
+        page_count = doc.page_count
+        # A single worker adds the pool round trip without any parallelism
+        if PAGE_WORKERS < 2 or page_count < PARALLEL_PAGE_THRESHOLD:
+            return [read_page_lines(page) for page in doc]
+    step = -(-page_count // PAGE_WORKERS)
+    starts = range(0, page_count, step)
+    stops = [min(start + step, page_count) for start in starts]
+    try:
+        chunks = read_page_ranges(path, starts, stops)
+    except BrokenProcessPool:
+        # The pool is shared, so it may have been broken by another request's
+        # document; retry once on a fresh pool before giving up
+        chunks = read_page_ranges(path, starts, stops)
+    return [lines for chunk in chunks for lines in chunk]
+
+def extract_transactions(path, layout, debug=False):
+    # Synchronous and CPU-bound; the endpoint runs it in the threadpool
     debug_lines = []
     all_lines = []
     transactions = []
 
-    zones = COLUMN_ZONES.get(bank.lower())
-    if not zones:
-        raise HTTPException(status_code=400, detail=f"Unsupported bank layout: {bank}")
-
-    with fitz.open(stream=content, filetype="pdf") as doc:
-        for page_number, page in enumerate(doc, start=1):
-            lines = extract_lines_by_y(page)
+    for page_number, lines in enumerate(read_document_lines(path), start=1):
+        if debug:
             debug_lines.append(f"--- Page {page_number} ---")
-            debug_lines.extend([l["line"] for l in lines])
-            all_lines.extend(lines)
-
-    blocks = []
-    current_block = []
-    for line in all_lines:
-        x_start = line["positions"][0] if line["positions"] else 0
-        first_word = line["line"].split()[0] if line["line"].split() else ""
-        if x_start < 100 and not is_date(first_word):
-            continue
-        if is_date(first_word):
-            if current_block:
-                blocks.append(current_block)
-                current_block = []
-        current_block.append(line)
-    if current_block:
-        blocks.append(current_block)
+            debug_lines.extend(" ".join(l["words"]) for l in lines)
+        all_lines.extend(lines)
 
+    blocks = split_blocks(all_lines, layout.date_x_threshold)
+
+    append_transaction = transactions.append
     previous_balance = None
 
     for block in blocks:
-        match = re.match(r"^(\d{1,2}[\/\-\s]\d{1,2}[\/\-\s]\d{2,4})", block[0]["line"])
-        if not match:
+        date = block_date(block[0]["words"][0])
+        if date is None:
             continue
 
-        date_str = match.group(1).replace(" ", "/").replace("-", "/")
-        try:
-            date = datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m-%d")
-        except:
-            continue
+        description_parts, amounts = classify_block(block, layout)
+
+        debit = amounts.get("debit")
+        credit = amounts.get("credit")
 
-        description_parts = []
-        debit_amount = None
-        credit_amount = None
-        balance_amount = None
-
-        for i, line in enumerate(block):
-            for j, (x, word) in enumerate(line["xmap"]):
-                word_clean = word.replace(" ", "")
-                if i == 0 and j == 0 and is_date(word):
-                    continue
-                if zones["description"][0] <= x < zones["description"][1] and not is_amount(word):
-                    description_parts.append(word)
-                elif zones["debit"][0] <= x < zones["debit"][1] and is_amount(word):
-                    debit_amount = float(word_clean)
-                elif zones["credit"][0] <= x < zones["credit"][1] and is_amount(word):
-                    credit_amount = float(word_clean)
-                elif x >= zones["balance"][0] and is_amount(word):
-                    balance_amount = float(word_clean)
-
-        description = " ".join(description_parts).strip()
-        amount_val = 0.0
-
-        if credit_amount is not None:
-            amount_val = credit_amount
-        elif debit_amount is not None:
-            amount_val = -debit_amount
-
-        balance_val = balance_amount if balance_amount is not None else (previous_balance if previous_balance is not None else 0.0)
+        # Fees and recurring payments repeat the same description many times
+        description = intern(" ".join(description_parts))
+
+        # All money is handled as integer cents and only formatted on output
+        amount = 0
+        if credit is not None:
+            amount = credit
+        elif debit is not None:
+            amount = -debit
+
+        balance = amounts.get("balance")
+        if balance is None:
+            balance = previous_balance if previous_balance is not None else 0
         balance_diff_error = ""
 
         if previous_balance is not None:
-            calc_amount = round(balance_val - previous_balance, 2)
-            if abs(calc_amount - amount_val) > 0.01:
-                balance_diff_error = f"Expected {calc_amount:.2f}, got {amount_val:.2f}"
-                amount_val = calc_amount
+            calc_amount = balance - previous_balance
+            if calc_amount != amount:
+                balance_diff_error = f"Expected {format_cents(calc_amount)}, got {format_cents(amount)}"
+                amount = calc_amount
 
-        previous_balance = balance_val
+        previous_balance = balance
 
-        transactions.append({
+        balance_str = format_cents(balance)
+        append_transaction({
             "date": date,
             "description": description,
-            "amount": f"{amount_val:.2f}",
-            "balance": f"{balance_val:.2f}",
-            "calculated_balance": f"{balance_val:.2f}",
-            "type": "credit" if amount_val > 0 else ("debit" if amount_val < 0 else "balance"),
+            "amount": format_cents(amount),
+            "balance": balance_str,
+            "calculated_balance": balance_str,
+            "type": "credit" if amount > 0 else ("debit" if amount < 0 else "balance"),
             "balance_diff_error": balance_diff_error
         })
 
+    return transactions, debug_lines
+
+# Rows per chunk when streaming CSV; one chunk per row would cost a
+# threadpool hop per row in StreamingResponse
+CSV_STREAM_BATCH = 500
+
+def iter_csv(transactions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    for start in range(0, len(transactions), CSV_STREAM_BATCH):
+        batch = transactions[start:start + CSV_STREAM_BATCH]
+        writer.writerows(tuple(row[k] for k in CSV_FIELDS) for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+def spool_upload(upload):
+    # Copy the upload to disk in chunks so MuPDF reads it by path and the
+    # whole PDF is never held in memory as one bytes object. This is blocking
+    # file I/O, so the endpoint runs it in the threadpool
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        try:
+            shutil.copyfileobj(upload, tmp, UPLOAD_CHUNK_SIZE)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    return tmp.name
+
+@app.post("/parse")
+async def parse_pdf(file: UploadFile = File(...), bank: str = Query("absa"), debug: bool = Query(False), preview: bool = Query(False), as_csv: bool = Query(False, alias="csv")):
+    layout = BANK_LAYOUTS.get(bank.lower())
+    if not layout:
+        raise HTTPException(status_code=400, detail=f"Unsupported bank layout: {bank}")
+
+    path = await run_in_threadpool(spool_upload, file.file)
+    try:
+        transactions, debug_lines = await run_in_threadpool(extract_transactions, path, layout, debug)
+    finally:
+        os.unlink(path)
+
     if not transactions:
         raise HTTPException(status_code=400, detail="No transactions found in PDF")
 
     if preview:
-        return JSONResponse(content={"preview": transactions})
+        return OrjsonResponse(content={"preview": transactions})
+
+    if as_csv:
+        return StreamingResponse(
+            iter_csv(transactions),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="transactions.csv"'}
+        )
 
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=["date", "description", "amount", "balance", "calculated_balance", "type", "balance_diff_error"])
-    writer.writeheader()
-    for row in transactions:
-        writer.writerow(row)
-    output.seek(0)
-    csv_string = output.getvalue()
+    csv_string = "".join(iter_csv(transactions))
 
-    return JSONResponse(content={
+    response = {
         "success": True,
         "transactions": transactions,
         "csvData": csv_string
-    })
+    }
+    if debug:
+        response["debugLines"] = debug_lines
+    return OrjsonResponse(content=response)
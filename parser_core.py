@@ -0,0 +1,172 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from types import MappingProxyType
+from typing import Any
+import re
+
+# Pure parsing helpers with no FastAPI or PyMuPDF dependency. Everything here
+# is annotated so the module can be compiled ahead of time with mypyc
+# (`mypyc parser_core.py`) without changing the callers in main.py.
+
+# A PyMuPDF "words" entry: x0, y0, x1, y1, text, block, line, word number
+Word = tuple[float, float, float, float, str, int, int, int]
+# A text line: its y, and the x positions and texts of its words in order
+Line = dict[str, Any]
+# Column name -> (left x, right x)
+Zones = dict[str, tuple[float, float]]
+
+def extract_lines_by_y(words: list[Word]) -> list[Line]:
+    if not words:
+        return []
+
+    # A single sort on (y, x) replaces per-line buckets and per-bucket sorts.
+    # y is snapped to an integer grid of 0.1pt: int keys hash and compare
+    # faster than floats and don't drift with float rounding
+    keyed = sorted((round(w[1] * 10), w[0], w[4]) for w in words)
+
+    ordered_lines: list[Line] = []
+    for y_key, group in groupby(keyed, key=itemgetter(0)):
+        # Keep x positions and words as parallel tuples rather than pairs
+        _, xs, line_words = zip(*group)
+        line = {
+            "y": y_key / 10,
+            "xs": xs,
+            "words": line_words
+        }
+        ordered_lines.append(line)
+
+    return ordered_lines
+
+_DATE_SHAPE = re.compile(r"\d{1,2}[\/\-\s]\d{1,2}[\/\-\s]\d{2,4}")
+
+def is_date(text: str) -> bool:
+    # Every date starts with a digit and is at least 6 characters ("1/2/23");
+    # headers, footers, page numbers and description words are turned away
+    # before the regex engine is entered
+    return len(text) >= 6 and text[0].isdigit() and _DATE_SHAPE.fullmatch(text) is not None
+
+_DATE_PREFIX = re.compile(r"^(\d{1,2})[\/\-\s](\d{1,2})[\/\-\s](\d{2,4})")
+
+@lru_cache(maxsize=4096)
+def parse_date(day: str, month: str, year: str) -> str | None:
+    # Build the date from the captured fields instead of going through strptime;
+    # two-digit years are taken as 20xx
+    if len(year) == 2:
+        year = "20" + year
+    elif len(year) != 4:
+        return None
+    y, m, d = int(year), int(month), int(day)
+    try:
+        datetime(y, m, d)  # rejects impossible dates such as 31/02
+    except ValueError:
+        return None
+    return f"{y:04d}-{m:02d}-{d:02d}"
+
+def block_date(text: str) -> str | None:
+    match = _DATE_PREFIX.match(text)
+    if not match:
+        return None
+    return parse_date(*match.groups())
+
+_AMOUNT_SHAPE = re.compile(r"[\d\s]+\.\d{2}")
+
+def is_amount(text: str) -> bool:
+    # Amounts always end in ".dd"; checking that first rejects most
+    # description words without entering the regex engine
+    return text[-3:-2] == "." and _AMOUNT_SHAPE.fullmatch(text) is not None
+
+# Thousands separators seen in amounts (every Unicode space separator, Zs,
+# which covers the no-break and thin spaces some statements use) plus the
+# decimal point: is_amount guarantees exactly two decimals, so what is left
+# is the amount in cents
+_AMOUNT_STRIP = str.maketrans("", "", ". \u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u202f\u205f\u3000")
+
+def parse_cents(text: str) -> int:
+    return int(text.translate(_AMOUNT_STRIP))
+
+def format_cents(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    whole, frac = divmod(abs(cents), 100)
+    return f"{sign}{whole}.{frac:02d}"
+
+# Define column zones per bank
+COLUMN_ZONES: dict[str, Zones] = {
+    "absa": {
+        "description": (95, 305),
+        "debit": (310, 390),
+        "credit": (395, 470),
+        "balance": (475, 999)
+    },
+    # Future banks can be added here
+}
+
+def build_zone_table(zones: Zones) -> tuple[list[float], list[str | None]]:
+    # Flatten the zones into sorted edges so bisect_right(edges, x) indexes
+    # the column name (or None for the gaps between columns)
+    edges: list[float] = []
+    fields: list[str | None] = [None]
+    for name, (lo, hi) in sorted(zones.items(), key=lambda item: item[1][0]):
+        edges.extend((lo, hi))
+        fields.extend((name, None))
+    # The rightmost (balance) column is open-ended
+    return edges[:-1], fields[:-1]
+
+# Lines starting left of this x are only kept when they begin with a date
+DATE_X_THRESHOLD = 100
+
+@dataclass(frozen=True, slots=True)
+class BankLayout:
+    zone_edges: tuple[float, ...]
+    zone_fields: tuple[str | None, ...]
+    date_x_threshold: float
+
+def compile_layout(zones: Zones, date_x_threshold: float = DATE_X_THRESHOLD) -> BankLayout:
+    edges, fields = build_zone_table(zones)
+    return BankLayout(tuple(edges), tuple(fields), date_x_threshold)
+
+# Derived once at import so requests only do a single dict lookup; read-only
+# so the layouts shared by all requests can't be changed underneath them
+BANK_LAYOUTS = MappingProxyType({bank: compile_layout(zones) for bank, zones in COLUMN_ZONES.items()})
+
+def split_blocks(lines: list[Line], date_x_threshold: float) -> list[list[Line]]:
+    # Block boundaries only need the date shape of each line's first word;
+    # the date itself is parsed once per block afterwards. Dates sit left of
+    # the threshold, so lines starting right of it are continuation lines
+    # and never reach the date check
+    blocks: list[list[Line]] = []
+    current_block: list[Line] = []
+    for line in lines:
+        if line["xs"][0] < date_x_threshold:
+            if not is_date(line["words"][0]):
+                continue
+            if current_block:
+                blocks.append(current_block)
+                current_block = []
+        current_block.append(line)
+    if current_block:
+        blocks.append(current_block)
+    return blocks
+
+def classify_block(block: list[Line], layout: BankLayout) -> tuple[list[str], dict[str, int]]:
+    # Sort a block's words into description words and per-column amounts in cents
+    zone_edges = layout.zone_edges
+    zone_fields = layout.zone_fields
+    description_parts: list[str] = []
+    amounts: dict[str, int] = {}
+
+    for i, line in enumerate(block):
+        for j, (x, word) in enumerate(zip(line["xs"], line["words"])):
+            if i == 0 and j == 0 and is_date(word):
+                continue
+            field = zone_fields[bisect_right(zone_edges, x)]
+            if field == "description":
+                if not is_amount(word):
+                    description_parts.append(word)
+            elif field is not None and is_amount(word):
+                amounts[field] = parse_cents(word)
+
+    return description_parts, amounts